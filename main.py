@@ -1,17 +1,38 @@
 import os
+import asyncio
 import logging
-import json
+import re
 import glob
+import hashlib
+import pickle
+import secrets
+import threading
+from functools import cache, lru_cache
+from collections import Counter, deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+import orjson
+import marisa_trie
+try:
+    # ISA-L's SIMD inflate is several times faster than zlib; same API as the stdlib module.
+    from isal import igzip
+except ImportError:
+    import gzip as igzip
 from fastapi import FastAPI, Request, Response
-from telegram import Update
+from telegram import Chat, Update
 from telegram.ext import Application, CommandHandler, ContextTypes
 
 # --- Logging Setup ---
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# basicConfig raises on unknown level names, which would stop the bot from starting.
+log_level_valid = LOG_LEVEL in logging.getLevelNamesMapping()
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+    level=LOG_LEVEL if log_level_valid else logging.INFO
 )
 logger = logging.getLogger(__name__)
+if not log_level_valid:
+    logger.warning("Unknown LOG_LEVEL %r; using INFO.", LOG_LEVEL)
 
 # --- Environment Variables ---
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
@@ -22,73 +43,297 @@ if not BOT_TOKEN or not RENDER_EXTERNAL_URL:
     exit()
 
 WEBHOOK_URL = f"{RENDER_EXTERNAL_URL}/webhook"
+# Telegram echoes this back in every webhook call; a random per-process value works
+# because the webhook is re-registered on each startup.
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+# Snapshot of the built index, reused on restart while the data files are unchanged.
+# Set to an empty string to disable.
+INDEX_CACHE_PATH = os.environ.get("INDEX_CACHE_PATH", "index.pkl")
+# Only the data files are fingerprinted, so bump this whenever the pickled layout or the
+# indexing/normalization rules change; older snapshots are then rebuilt instead of reused.
+INDEX_CACHE_VERSION = 3
 
 # --- Data Loading ---
-user_data_by_mobile = {}
-user_data_by_email = {}
+# Row store: records[row] is a tuple of values and record_fields[row] the matching tuple of
+# field names, shared by every row with the same schema. Much smaller than a dict per record.
+records = []
+record_fields = []
+# Normalized mobile numbers and emails never collide, so one map serves both. It is a
+# dict of key -> row while loading, then frozen into a marisa-trie RecordTrie.
+user_data = {}
+# Set once the background load has finished (successfully or not).
+index_ready = False
+# Set on shutdown; the loader checks it between files so a cold load doesn't hold up exit.
+stop_loading = threading.Event()
+
+NON_DIGITS = re.compile(r'\D', re.ASCII)
+
+def normalize_mobile(value):
+    """Reduces a phone number to its digits, so '+91 98765-43210' and 919876543210 match."""
+    # Phone numbers are usually already str (query args, most data files); skip the str() call.
+    return NON_DIGITS.sub('', value if type(value) is str else str(value))
+
+def normalize_email(value):
+    return value.strip().casefold()
+
+def normalize_query(query):
+    """Normalizes a /search argument the same way the matching index key was normalized."""
+    return normalize_email(query) if '@' in query else normalize_mobile(query)
+
+def lookup_row(key):
+    """Returns the row indexed under key, or None."""
+    hits = user_data.get(key)
+    return hits[0][0] if hits else None
+
+def record_items(row):
+    """Returns the (field, value) pairs of the record stored at the given row."""
+    return zip(record_fields[row], records[row])
+
+def read_data_file(file_path):
+    """Reads a data file as raw bytes, decompressing .json.gz files (with ISA-L when available)."""
+    with open(file_path, 'rb') as f:
+        raw = f.read()
+    if file_path.endswith('.gz'):
+        raw = igzip.decompress(raw)
+    return raw
+
+def fetch_data_file(file_path):
+    """Reads a data file and fingerprints its decompressed content; runs in a worker thread."""
+    raw = read_data_file(file_path)
+    return hashlib.blake2b(raw, digest_size=16).digest(), raw
+
+# Records sampled per file to decide which fields have repeating values worth pooling.
+POOL_SAMPLE_SIZE = 1000
+
+def repeating_fields(batch):
+    """Returns the fields whose short string values repeat within a sample of the batch.
+
+    Unique values (phones, emails, names) are left out: pooling them would only add a pool
+    entry per value for the whole load without sharing anything.
+    """
+    values_by_field = {}
+    for record in islice((r for r in batch if isinstance(r, dict)), POOL_SAMPLE_SIZE):
+        for key, value in record.items():
+            if isinstance(value, str) and len(value) < 32:
+                values_by_field.setdefault(key, []).append(value)
+    return {
+        key for key, values in values_by_field.items()
+        if key not in ('phone', 'email') and len(set(values)) * 2 <= len(values)
+    }
+
+def index_records(batch, pool):
+    """Adds a batch of parsed records to the row store and the shared mobile/email index.
+
+    pool hands out canonical copies of field-name tuples and of short string values in
+    fields that repeat (city, carrier, ...), so those values and each schema are stored once.
+    """
+    # Locals instead of globals/attributes: this loop runs once per record.
+    pooled = pool.setdefault
+    shared_fields = repeating_fields(batch)
+    index = user_data
+    append_values = records.append
+    append_fields = record_fields.append
+    row = len(records)
+    for record in batch:
+        if not isinstance(record, dict):
+            continue
+        phone = record.get('phone')
+        email = record.get('email')
+        mobile = normalize_mobile(phone) if phone is not None else None
+        # Same '@' test as normalize_query: anything else would be searched as a mobile
+        # number and could overwrite a real mobile key in the shared index.
+        email = normalize_email(email) if isinstance(email, str) and '@' in email else None
+        if not mobile and not email:
+            continue
+        append_values(tuple([
+            pooled(value, value) if key in shared_fields and isinstance(value, str) and len(value) < 32 else value
+            for key, value in record.items()
+        ]))
+        fields = tuple(record)
+        append_fields(pooled(fields, fields))
+        if mobile:
+            index[mobile] = row
+        if email:
+            index[email] = row
+        row += 1
+
+def freeze_index():
+    """Swaps the user_data dict for a static trie, about 10x smaller for millions of keys."""
+    global user_data
+    user_data = marisa_trie.RecordTrie('<I', ((key, (row,)) for key, row in user_data.items()))
+
+def data_manifest(data_files):
+    """Identifies the current data set by each file's path, size and modification time."""
+    manifest = []
+    for path in sorted(data_files):
+        stat = os.stat(path)
+        manifest.append((path, stat.st_size, stat.st_mtime_ns))
+    return manifest
+
+def load_cached_index(manifest):
+    """Restores the index from INDEX_CACHE_PATH if it was built from the same data files."""
+    global records, record_fields, user_data
+    if not INDEX_CACHE_PATH:
+        return False
+    try:
+        with open(INDEX_CACHE_PATH, 'rb') as f:
+            # The manifest is pickled separately first, so a stale cache is rejected
+            # without unpickling the whole index.
+            if pickle.load(f) != (INDEX_CACHE_VERSION, manifest):
+                logger.info("Index cache %s is stale; rebuilding.", INDEX_CACHE_PATH)
+                return False
+            records, record_fields, user_data = pickle.load(f)
+    except FileNotFoundError:
+        return False
+    except Exception as e:
+        logger.warning("Ignoring unreadable index cache %s: %s", INDEX_CACHE_PATH, e)
+        return False
+    return True
+
+def save_cached_index(manifest):
+    """Writes the index to INDEX_CACHE_PATH, replacing any previous snapshot atomically."""
+    if not INDEX_CACHE_PATH:
+        return
+    tmp_path = f"{INDEX_CACHE_PATH}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((INDEX_CACHE_VERSION, manifest), f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump((records, record_fields, user_data), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, INDEX_CACHE_PATH)
+    except Exception as e:
+        logger.warning("Failed to write index cache %s: %s", INDEX_CACHE_PATH, e)
 
 def load_and_index_data():
-    """Loads and indexes data from all .json files in the 'datajson/' directory."""
+    """Loads and indexes data from all .json and .json.gz files in the 'datajson/' directory."""
     logger.info("Starting data load from .json files...")
-    data_files = glob.glob("datajson/*.json")
+    data_files = glob.glob("datajson/*.json") + glob.glob("datajson/*.json.gz")
     
-    logger.info(f"Found data files: {data_files}")
+    logger.info("Found data files: %s", data_files)
 
     if not data_files:
         logger.warning("No data files found in 'datajson/' directory. Search will not work.")
         return
+
+    manifest = data_manifest(data_files)
+    if load_cached_index(manifest):
+        logger.info("Loaded index of %d records from %s.", len(records), INDEX_CACHE_PATH)
+        return
         
-    all_records = []
-    for file_path in data_files:
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                if isinstance(data, dict):
-                    all_records.extend(data.values())
-                elif isinstance(data, list):
-                    all_records.extend(data)
-        except Exception as e:
-            logger.error(f"Failed to load or parse {file_path}: {e}")
-            
-    for record in all_records:
-        if 'phone' in record:
-            user_data_by_mobile[str(record['phone'])] = record
-        if 'email' in record and isinstance(record['email'], str):
-            user_data_by_email[record['email'].lower()] = record
+    # Only needed while loading; dropping it afterwards keeps no lookup table alive.
+    pool = {}
+    # Content digests of loaded files, so a copy saved under another name is indexed once.
+    seen_digests = set()
+    # A snapshot that silently misses a file would never retry it, so only cache clean loads.
+    failed_files = 0
+    # Reading and ISA-L decompression release the GIL, so the next files are fetched while
+    # the main thread parses and indexes them in order. The parser handles one file at a
+    # time, so prefetching more than two only holds more decompressed bytes in memory
+    # (and os.cpu_count() reports the host, not the container's CPU quota).
+    max_workers = min(len(data_files), 2)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        paths = iter(data_files)
+        pending = deque((path, executor.submit(fetch_data_file, path)) for path in islice(paths, max_workers))
+        while pending:
+            if stop_loading.is_set():
+                logger.info("Data load cancelled by shutdown.")
+                return
+            file_path, future = pending.popleft()
+            next_path = next(paths, None)
+            if next_path is not None:
+                pending.append((next_path, executor.submit(fetch_data_file, next_path)))
+            try:
+                digest, raw = future.result()
+                if digest in seen_digests:
+                    logger.info("Skipping %s: same content as an already loaded file.", file_path)
+                    continue
+                seen_digests.add(digest)
+                data = orjson.loads(raw)
+            except Exception as e:
+                logger.error("Failed to load or parse %s: %s", file_path, e)
+                failed_files += 1
+                continue
+            finally:
+                # Release the file's bytes before indexing it.
+                del future
+                raw = None
+            if isinstance(data, dict):
+                batch = data.values()
+            elif isinstance(data, list):
+                batch = data
+            else:
+                continue
+            # Index per file instead of building one combined list of all records.
+            index_records(batch, pool)
+            del data, batch
             
-    logger.info(f"Successfully indexed {len(all_records)} records.")
+    # index_records skips entries without a usable phone or email, so count what was stored.
+    logger.info("Successfully indexed %d records.", len(records))
+    if stop_loading.is_set():
+        return
+    freeze_index()
+    if failed_files:
+        logger.warning("Not caching the index: %d data file(s) failed to load.", failed_files)
+    else:
+        save_cached_index(manifest)
 
 # --- Telegram Bot Setup ---
 tg_app = Application.builder().token(BOT_TOKEN).build()
 
+# --- MarkdownV2 Escaping ---
+# Every character Telegram reserves in MarkdownV2, escaped in a single C-level pass.
+MARKDOWN_V2_ESCAPE = str.maketrans({c: '\\' + c for c in '\\_*[]()~`>#+-=|{}.!'})
+
+@cache
+def escape_field_name(key):
+    """Escapes a record field name, memoized since records share a small fixed schema."""
+    return str(key).translate(MARKDOWN_V2_ESCAPE)
+
 # --- Bot Handlers ---
+# Reply builders return (text, parse_mode) so the same reply can be sent either by a
+# PTB handler or inline in the webhook response.
+def build_start_reply(args):
+    return "Bot is running. Use /search, /stats, or /debug.", None
+
+@lru_cache(maxsize=1024)
+def render_record(row):
+    """Formats a record as a MarkdownV2 reply; cached per row since records never change once loaded."""
+    lines = ["✅ **User Data Found**\n"]
+    for key, value in record_items(row):
+        lines.append(f"*{escape_field_name(key)}:* `{str(value).translate(MARKDOWN_V2_ESCAPE)}`")
+    return "\n".join(lines) + "\n"
+
+def build_search_reply(args):
+    if not args:
+        return "Usage: `/search 9876543210`", 'MarkdownV2'
+    if not index_ready:
+        return "⏳ Data is still loading, please try again in a minute.", None
+    # PTB splits on whitespace, so '/search +91 98765 43210' arrives as three args.
+    query = normalize_query(' '.join(args))
+    row = lookup_row(query)
+    if row is None:
+        return "❌ No record found for that query.", None
+    return render_record(row), 'MarkdownV2'
+
+def build_stats_reply(args):
+    message = (
+        f"📊 **Current Index Stats**\n\n"
+        f"Records loaded: `{len(records)}`\n"
+        f"Lookup keys \\(mobile \\+ email\\): `{len(user_data)}`"
+    )
+    return message, 'MarkdownV2'
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Bot is running. Use /search, /stats, or /debug.")
+    text, parse_mode = build_start_reply(context.args)
+    await update.message.reply_text(text, parse_mode=parse_mode)
 
 async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not context.args:
-        await update.message.reply_text("Usage: `/search 9876543210`", parse_mode='MarkdownV2')
-        return
-    query = context.args[0].lower()
-    result = user_data_by_mobile.get(query) or user_data_by_email.get(query)
-    if result:
-        message = "✅ **User Data Found**\n\n"
-        for key, value in result.items():
-            key_safe = str(key).replace('_', '\\_').replace('-', '\\-').replace('.', '\\.')
-            value_safe = str(value).replace('-', '\\-').replace('.', '\\.')
-            message += f"*{key_safe}:* `{value_safe}`\n"
-        await update.message.reply_text(message, parse_mode='MarkdownV2')
-    else:
-        await update.message.reply_text("❌ No record found for that query.")
+    text, parse_mode = build_search_reply(context.args)
+    await update.message.reply_text(text, parse_mode=parse_mode)
 
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Displays the number of records currently loaded in memory."""
-    message = (
-        f"📊 **Current Index Stats**\n\n"
-        f"Records indexed by mobile: `{len(user_data_by_mobile)}`\n"
-        f"Records indexed by email: `{len(user_data_by_email)}`"
-    )
-    await update.message.reply_text(message, parse_mode='MarkdownV2')
+    text, parse_mode = build_stats_reply(context.args)
+    await update.message.reply_text(text, parse_mode=parse_mode)
 
 async def debug(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Lists files and folders to help diagnose data loading issues."""
@@ -107,22 +352,79 @@ async def debug(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # Register handlers
-tg_app.add_handler(CommandHandler("start", start))
-tg_app.add_handler(CommandHandler("search", search))
-tg_app.add_handler(CommandHandler("stats", stats))
+start_handler = CommandHandler("start", start)
+search_handler = CommandHandler("search", search)
+stats_handler = CommandHandler("stats", stats)
+tg_app.add_handler(start_handler)
+tg_app.add_handler(search_handler)
+tg_app.add_handler(stats_handler)
 tg_app.add_handler(CommandHandler("debug", debug))
 
+# These commands only read the in-memory index, so the webhook answers them directly in
+# its response body instead of making a separate sendMessage round trip to Telegram.
+WEBHOOK_REPLY_HANDLERS = (
+    (start_handler, build_start_reply),
+    (search_handler, build_search_reply),
+    (stats_handler, build_stats_reply),
+)
+
+def build_webhook_reply(update):
+    """Returns a sendMessage payload for the update if a fast command matches it, else None."""
+    for handler, build_reply in WEBHOOK_REPLY_HANDLERS:
+        match = handler.check_update(update)
+        if match:
+            args, _ = match
+            text, parse_mode = build_reply(args)
+            message = update.effective_message
+            payload = {"method": "sendMessage", "chat_id": update.effective_chat.id, "text": text}
+            if parse_mode:
+                payload["parse_mode"] = parse_mode
+            # Match what reply_text does: stay in the forum topic and quote the command
+            # outside private chats.
+            if message.is_topic_message:
+                payload["message_thread_id"] = message.message_thread_id
+            if update.effective_chat.type != Chat.PRIVATE:
+                payload["reply_parameters"] = {"message_id": message.message_id}
+            return payload
+    return None
+
 # --- FastAPI Web Server ---
+async def load_data_in_background():
+    """Builds the index in a worker thread so the server keeps serving during a cold load.
+
+    orjson parsing and the trie build hold the GIL, so the event loop still stalls while a
+    large file is parsed or the trie is built (~1.3s for 2M keys); requests are answered
+    between those steps rather than continuously.
+    """
+    global index_ready, user_data
+    try:
+        await asyncio.to_thread(load_and_index_data)
+    except Exception:
+        logger.exception("Data load failed. Search will not work.")
+    finally:
+        # A failed or cancelled load may stop before freeze_index; lookup_row only
+        # understands the frozen trie, so fall back to an empty index, not a half-built dict.
+        if not isinstance(user_data, marisa_trie.RecordTrie):
+            user_data = {}
+        index_ready = True
+
 async def lifespan(app: FastAPI):
     # On startup
-    load_and_index_data()
+    app.state.data_loader = asyncio.create_task(load_data_in_background())
     await tg_app.initialize()
-    await tg_app.bot.set_webhook(url=WEBHOOK_URL, allowed_updates=Update.ALL_TYPES)
-    logger.info(f"Webhook set successfully to {WEBHOOK_URL}")
+    await tg_app.start()
+    await tg_app.bot.set_webhook(
+        url=WEBHOOK_URL, allowed_updates=Update.ALL_TYPES, secret_token=WEBHOOK_SECRET
+    )
+    logger.info("Webhook set successfully to %s", WEBHOOK_URL)
     yield
     # On shutdown
+    # A running thread can't be cancelled; ask the loader to stop at the next file boundary.
+    stop_loading.set()
     await tg_app.bot.delete_webhook()
+    await tg_app.stop()
     await tg_app.shutdown()
+    await app.state.data_loader
     logger.info("Bot shutdown complete.")
 
 app = FastAPI(lifespan=lifespan)
@@ -136,14 +438,31 @@ def index_get():
 def index_head():
     return Response(status_code=200)
 
+# Per exception type, so a burst of identical bad requests doesn't flood the log.
+webhook_error_counts = Counter()
+
 @app.post("/webhook")
 async def webhook(request: Request):
     """The main webhook endpoint that receives updates from Telegram."""
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    # Compare bytes: compare_digest raises TypeError on non-ASCII str, and header values
+    # are latin-1 decoded, so any client could otherwise trigger a 500.
+    if not secrets.compare_digest(secret.encode('latin-1'), WEBHOOK_SECRET.encode()):
+        return Response(status_code=403)
     try:
-        data = await request.json()
+        data = orjson.loads(await request.body())
         update = Update.de_json(data, tg_app.bot)
-        await tg_app.process_update(update)
+        payload = build_webhook_reply(update)
+        if payload is not None:
+            return Response(content=orjson.dumps(payload), media_type="application/json")
+        # Acknowledge right away; the Application's update fetcher runs the handlers.
+        tg_app.update_queue.put_nowait(update)
         return Response(status_code=200)
     except Exception as e:
-        logger.error(f"Error in webhook: {e}")
+        error_type = type(e).__name__
+        webhook_error_counts[error_type] += 1
+        seen = webhook_error_counts[error_type]
+        # Log the first occurrence of each error type, then every 100th repeat.
+        if seen % 100 == 1:
+            logger.warning("Error in webhook (%s, seen %d times): %s", error_type, seen, e)
         return Response(status_code=500)